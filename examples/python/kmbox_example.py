@@ -1,9 +1,12 @@
+import asyncio
+import atexit
+import ctypes
 import kmNet
 import grpc
 import pyautogui
+import sys
 import time
 
-from random import Random
 from concurrent import futures
 # The two imports below is generated from:
 # python -m grpc_tools.protoc --python_out=. --pyi_out=. --grpc_python_out=. -I../../backend/proto ../..
@@ -12,19 +15,99 @@ from input_pb2 import Key, KeyRequest, KeyResponse, KeyDownRequest, KeyDownRespo
 from input_pb2_grpc import KeyInputServicer, add_KeyInputServicer_to_server
 
 
+async def sleep_until(deadline_ns: int) -> None:
+    # asyncio timers can fire early or late by up to the event loop clock resolution (~15.6ms on
+    # Windows before Python 3.13, regardless of timeBeginPeriod()), so this keeps sleeping for
+    # whatever is left and only spins, still yielding to other requests, for the last 2ms.
+    remaining_ns = deadline_ns - time.perf_counter_ns()
+    while remaining_ns > 2_000_000:
+        await asyncio.sleep((remaining_ns - 1_000_000) / 1_000_000_000)
+        remaining_ns = deadline_ns - time.perf_counter_ns()
+    while time.perf_counter_ns() < deadline_ns:
+        await asyncio.sleep(0)
+
+
+def use_precise_timer() -> None:
+    # Windows timers tick every ~15.6ms by default, which is coarser than most key holds.
+    if sys.platform == "win32":
+        winmm = ctypes.WinDLL("winmm")
+        winmm.timeBeginPeriod(1)
+        atexit.register(winmm.timeEndPeriod, 1)
+
+
 class KeyInput(KeyInputServicer):
     def __init__(self, keys_map: dict[Key, int]) -> None:
         super().__init__()
-        self.keys_map = keys_map
-        self.seed = None
+        # Key is a small contiguous enum so it can index a list directly instead of hashing into
+        # keys_map on every request.
+        self.keys_table = [None] * (max(keys_map) + 1)
+        for key, value in keys_map.items():
+            self.keys_table[key] = value
+        self.seed_int = None
+        self._rnd_state = 0
+        # The screen size does not change while the server is running. The cursor position is
+        # tracked from the deltas sent to KMBox instead of querying the OS on every request and is
+        # only re-synced in Init(). If something else moves the cursor, it drifts until the bot
+        # reconnects.
+        self._screen_width, self._screen_height = pyautogui.size()
+        self._cursor_x, self._cursor_y = pyautogui.position()
+        # These are for cropping the non-game UI portion of the app the game is running in. See
+        # SendMouse() for more details.
+        self.crop_left_px = 0  # Change this until it feels correct
+        self.crop_top_px = 30  # Change this until it feels correct
+        # Coefficients mapping bot coordinates to screen coordinates, keyed by the bot capture size.
+        self._mappings = {}
+        # grpc.aio.server() runs the handlers on the event loop, so unlike grpc.server() there is
+        # no handler thread pool whose max_workers silently caps concurrency. This pool only
+        # offloads the blocking kmNet calls. KMBox is a single device behind a single kmNet socket,
+        # so all commands go through one dedicated thread. This keeps them in the order they were
+        # sent and avoids threads contending for the socket, while key holds and mouse settle
+        # sleeps still overlap on the event loop.
+        self.kmbox_pool = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="kmbox")
+
+    def _mapping(self, width: int, height: int) -> tuple[float, float, float, float]:
+        key = (width, height)
+        # Moving the hit to the end keeps the least recently used size first for eviction.
+        mapping = self._mappings.pop(key, None)
+        if mapping is None:
+            # The capture size rarely changes so only the few most recently used ones are kept.
+            if len(self._mappings) >= 4:
+                del self._mappings[next(iter(self._mappings))]
+            ax = self._screen_width / (width - self.crop_left_px)
+            ay = self._screen_height / (height - self.crop_top_px)
+            mapping = (ax, -self.crop_left_px * ax, ay, -self.crop_top_px * ay)
+        self._mappings[key] = mapping
+        return mapping
+
+    # splitmix64, a single 64-bit state is plenty for delay jitter and much cheaper to step than
+    # random.Random.
+    def _next_random(self) -> int:
+        self._rnd_state = (self._rnd_state + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = self._rnd_state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        return z ^ (z >> 31)
+
+    # kmNet has no single click or scroll command, so these run the whole sequence in one pool
+    # call instead of one per command. This also keeps the commands in order on one thread.
+    def _click(self, dx: int, dy: int, ms: int) -> None:
+        kmNet.move_auto(dx, dy, ms)
+        kmNet.mouse(1, 0, 0, 0)
+        kmNet.mouse(0, 0, 0, 0)
+
+    def _scroll_down(self, dx: int, dy: int, ms: int) -> None:
+        kmNet.move_auto(dx, dy, ms)
+        kmNet.mouse(0, 0, 0, -1)
 
     # This is the init function that is called each time the bot connects to your service.
-    def Init(self, request: KeyInitRequest, context):
+    async def Init(self, request: KeyInitRequest, context):
         # This is a seed generated automatically by the bot for the first time the bot is run.
         # The seed is saved in the database and reused again later.
         # If you do not wish to use the bot provided delay for key down press, you can use this
         # seed for generating delay timing. The seed is a 32 bytes array.
-        self.seed = request.seed
+        self.seed_int = int.from_bytes(request.seed[:4], "little", signed=False)
+        self._rnd_state = self.seed_int
+        self._cursor_x, self._cursor_y = pyautogui.position()
 
         # There are two types of mouse coordinate depending on your setup:
         # - Relative: The MouseRequest coordinates (x, y, width, height) is relative to the
@@ -42,7 +125,7 @@ class KeyInput(KeyInputServicer):
         # return KeyInitResponse(mouse_coordinate=Coordinate.Screen)
         return KeyInitResponse(mouse_coordinate=Coordinate.Relative)
 
-    def SendMouse(self, request: MouseRequest, context):
+    async def SendMouse(self, request: MouseRequest, context):
         # Regardless of the type of Coordinate return in Init(), the coordinates are always based on
         # the PC the bot is running in. And there are two cases you should consider:
         #
@@ -70,9 +153,8 @@ class KeyInput(KeyInputServicer):
         # all you need the current cursor position in order to get the relative movement amount.
         #
         # You need to use Coordinate.Screen for this case.
-        # position = pyautogui.position()
-        # dx = x - position.x
-        # dy = y - position.y
+        # dx = x - self._cursor_x
+        # dy = y - self._cursor_y
 
         # Case 2: KMBox input server is in a different PC than the bot. This case can be
         # problematic depending on your setup. For instance, if you use GF Now, when running
@@ -87,74 +169,91 @@ class KeyInput(KeyInputServicer):
         # These are for cropping the non-game UI portion of the app the game is running in.
         # For Moonlight/Sunshine, you can leave this as-is. This method can be unreliable due
         # this reason. You can also use PowerToys Screen Ruler to measure this non-game UI area.
+        # The crop amounts are `self.crop_left_px` and `self.crop_top_px` in __init__().
 
         # Make sure you turn off 'Enhance pointer precision' in 'Mouse Properties' settings. That
         # seems to mess with KMBox relative movement. Pointer speed also affects the movement so
         # you should change it to the default speed (6).
-        screen_width, screen_height = pyautogui.size()
-        position = pyautogui.position()
 
         # Map coordinates from bot PC to input PC
-        crop_left_px = 0  # Change this until it feels correct
-        crop_top_px = 30  # Change this until it feels correct
-        scaled_x = int(
-            ((x - crop_left_px) / (width - crop_left_px)) * screen_width)
-        scaled_y = int(
-            ((y - crop_top_px) / (height - crop_top_px)) * screen_height)
+        ax, bx, ay, by = self._mapping(width, height)
+        scaled_x = int(x * ax + bx)
+        scaled_y = int(y * ay + by)
 
-        dx = scaled_x - position.x
-        dy = scaled_y - position.y
+        dx = scaled_x - self._cursor_x
+        dy = scaled_y - self._cursor_y
+        # The OS stops the cursor at the screen edges so the tracked position does too.
+        self._cursor_x = min(max(scaled_x, 0), self._screen_width - 1)
+        self._cursor_y = min(max(scaled_y, 0), self._screen_height - 1)
 
         # Common logics, not very human but just an example
-        seed_int = int.from_bytes(self.seed[:4], "little", signed=False)
-        rnd = Random(seed_int)
-        ms = rnd.randrange(200, 300)
+        ms = 200 + self._next_random() % 100
+        deadline = time.perf_counter_ns() + ms * 1_000_000
+        loop = asyncio.get_running_loop()
         if action == MouseAction.Move:
-            kmNet.move_auto(dx, dy, ms)
+            await loop.run_in_executor(self.kmbox_pool, kmNet.move_auto, dx, dy, ms)
         elif action == MouseAction.Click:
-            kmNet.move_auto(dx, dy, ms)
-            kmNet.mouse(1, 0, 0, 0)
-            kmNet.mouse(0, 0, 0, 0)
+            await loop.run_in_executor(self.kmbox_pool, self._click, dx, dy, ms)
         elif action == MouseAction.ScrollDown:
-            kmNet.move_auto(dx, dy, ms)
-            kmNet.mouse(0, 0, 0, -1)
+            await loop.run_in_executor(self.kmbox_pool, self._scroll_down, dx, dy, ms)
 
         # Sleep to ensure mouse movement completes since KMBox move_auto doesn't seem to block until
         # the move is actually complete.
         # If you let the mouse jump instead of sliding like above, sleep is probably not needed.
-        time.sleep(ms / 1000)
+        await sleep_until(deadline)
 
         return MouseResponse()
 
-    def Send(self, request: KeyRequest, context):
+    async def Send(self, request: KeyRequest, context):
         # This `key` is an enum representing the key the bot want your customized input to send.
         # You should map this to the key supported by your customized input method.
-        key = self.keys_map[request.key]
+        key = self.keys_table[request.key]
         # This is key down sleep milliseconds. It is generated automatically by the bot using the
-        # above seed. You should use this delay and `time.sleep(delay)` on key down.
-        key_down = request.down_ms / 1000.0
+        # above seed. You should hold the key down for this delay.
+        key_down_ns = int(request.down_ms * 1_000_000)
 
-        kmNet.keydown(key)
-        time.sleep(key_down)
-        kmNet.keyup(key)
+        # The hold is measured from before key down so the time spent sending it counts towards
+        # the hold instead of adding on top of it.
+        deadline = time.perf_counter_ns() + key_down_ns
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.kmbox_pool, kmNet.keydown, key)
+        await sleep_until(deadline)
+        await loop.run_in_executor(self.kmbox_pool, kmNet.keyup, key)
         return KeyResponse()
 
-    def SendUp(self, request: KeyUpRequest, context):
-        kmNet.keyup(self.keys_map[request.key])
+    async def SendUp(self, request: KeyUpRequest, context):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.kmbox_pool, kmNet.keyup, self.keys_table[request.key])
         return KeyUpResponse()
 
-    def SendDown(self, request: KeyDownRequest, context):
-        kmNet.keydown(self.keys_map[request.key])
+    async def SendDown(self, request: KeyDownRequest, context):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.kmbox_pool, kmNet.keydown, self.keys_table[request.key])
         return KeyDownResponse()
 
 
+async def serve(keys_map: dict[Key, int]) -> None:
+    # The bot keeps one connection open for the whole session, keepalive pings notice when it is
+    # dropped.
+    server = grpc.aio.server(options=[
+        ("grpc.keepalive_time_ms", 30000),
+        ("grpc.keepalive_timeout_ms", 10000),
+        ("grpc.http2.max_pings_without_data", 0),
+    ])
+    add_KeyInputServicer_to_server(KeyInput(keys_map), server)
+    server.add_insecure_port("[::]:5001")
+    await server.start()
+    print("Server started, listening on 5001")
+    await server.wait_for_termination()
+
+
 if __name__ == "__main__":
     kmNet.init("192.168.2.188", "8704", "33005C53")
     # Generated with ChatGPT, might not be accurate
     keys_map = {
         # Letters A-Z
         # A=0 -> HID 4, ..., Z=25 -> HID 29
-        **{Key.Value(Key.Name(i)): 4 + i for i in range(26)},
+        **{Key.A + i: 4 + i for i in range(26)},
 
         # Digits 0–9
         Key.Zero: 39,
@@ -209,9 +308,5 @@ if __name__ == "__main__":
         Key.Alt: 226,
     }
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    add_KeyInputServicer_to_server(KeyInput(keys_map), server)
-    server.add_insecure_port("[::]:5001")
-    server.start()
-    print("Server started, listening on 5001")
-    server.wait_for_termination()
+    use_precise_timer()
+    asyncio.run(serve(keys_map))
@@ -1,10 +1,14 @@
+import asyncio
+import atexit
+import ctypes
 import pywinauto
 import pyautogui
 import grpc
+import sys
 import time
 
 from concurrent import futures
-from pywinauto import WindowSpecification, keyboard
+from pywinauto import WindowSpecification, keyboard, win32functions, win32structures
 from pywinauto.application import Application
 # The two imports below is generated from:
 # python -m grpc_tools.protoc --python_out=. --pyi_out=. --grpc_python_out=. -I../../backend/proto ../..
@@ -13,14 +17,110 @@ from input_pb2 import Key, KeyRequest, KeyResponse, KeyDownRequest, KeyDownRespo
 from input_pb2_grpc import KeyInputServicer, add_KeyInputServicer_to_server
 
 
+async def sleep_until(deadline_ns: int) -> None:
+    # asyncio timers can fire early or late by up to the event loop clock resolution (~15.6ms on
+    # Windows before Python 3.13, regardless of timeBeginPeriod()), so this keeps sleeping for
+    # whatever is left and only spins, still yielding to other requests, for the last 2ms.
+    remaining_ns = deadline_ns - time.perf_counter_ns()
+    while remaining_ns > 2_000_000:
+        await asyncio.sleep((remaining_ns - 1_000_000) / 1_000_000_000)
+        remaining_ns = deadline_ns - time.perf_counter_ns()
+    while time.perf_counter_ns() < deadline_ns:
+        await asyncio.sleep(0)
+
+
+def use_precise_timer() -> None:
+    # Windows timers tick every ~15.6ms by default, which is coarser than most key holds.
+    if sys.platform == "win32":
+        winmm = ctypes.WinDLL("winmm")
+        winmm.timeBeginPeriod(1)
+        atexit.register(winmm.timeEndPeriod, 1)
+
+
+def key_input(vk: int, up: bool) -> win32structures.INPUT:
+    # Builds the same keyboard INPUT that send_keys(vk_packet=False) would for a virtual key.
+    inp = win32structures.INPUT()
+    inp.type = keyboard.INPUT_KEYBOARD
+    inp.ki.wVk = vk
+    inp.ki.wScan = win32functions.MapVirtualKeyW(vk, 0)
+    if 33 <= vk <= 46 or 91 <= vk <= 93:
+        inp.ki.dwFlags = keyboard.KEYEVENTF_EXTENDEDKEY
+    if up:
+        inp.ki.dwFlags |= keyboard.KEYEVENTF_KEYUP
+    inp.ki.dwExtraInfo = win32functions.GetMessageExtraInfo()
+    return inp
+
+
 class KeyInput(KeyInputServicer):
     def __init__(self, window: WindowSpecification, keys_map: dict[Key, str]) -> None:
         super().__init__()
         self.window = window
-        self.keys_map = keys_map
+        # has_keyboard_focus() goes through several Win32 calls, so the result is reused for a
+        # short while instead of being queried on every request.
+        self._focus_ttl = 0.05
+        self._focus_cached_at = 0.0
+        self._focus_value = False
+        # Key is a small contiguous enum so it can index a list directly instead of hashing into
+        # keys_map on every request. The key down and up INPUTs are built once here and sent with
+        # SendInput() directly, instead of send_keys() parsing a key string on every request. The
+        # key names are resolved to virtual keys the same way send_keys(vk_packet=False) does.
+        self.down_inputs = [None] * (max(keys_map) + 1)
+        self.up_inputs = [None] * (max(keys_map) + 1)
+        for key, value in keys_map.items():
+            vk = keyboard.CODES[value] if value in keyboard.CODES else keyboard.ascii_vk[value]
+            self.down_inputs[key] = key_input(vk, False)
+            self.up_inputs[key] = key_input(vk, True)
+        self._send_input_fn = win32functions.SendInput
+        self._input_size = ctypes.sizeof(win32structures.INPUT)
+        # These are for cropping the non-game UI portion of the app the game is running in. See
+        # SendMouse() for more details.
+        self.crop_left_px = 0  # Change this until it feels correct
+        self.crop_top_px = 30  # Change this until it feels correct
+        self.game_width = 1366  # Assuming your game is 1366x768 full screen
+        self.game_height = 768  # Assuming your game is 1366x768 full screen
+        # Coefficients mapping bot coordinates to game coordinates, keyed by the bot capture size.
+        self._mappings = {}
+        # grpc.aio.server() runs the handlers on the event loop, so unlike grpc.server() there is
+        # no handler thread pool whose max_workers silently caps concurrency. This pool only
+        # offloads the blocking pyautogui calls. pyautogui is not thread-safe and mouse actions
+        # must not interleave, so they all go through one thread in the order they were sent.
+        # SendInput() returns immediately so key input is sent on the event loop.
+        self.io_pool = futures.ThreadPoolExecutor(max_workers=1)
+
+    def _send_input(self, inp: win32structures.INPUT) -> None:
+        # SendInput() returns 0 when the input is blocked, e.g. by UIPI or a locked desktop.
+        if self._send_input_fn(1, ctypes.byref(inp), self._input_size) != 1:
+            raise RuntimeError("SendInput() inserted only 0 out of 1 keyboard events")
+
+    def _focused(self) -> bool:
+        now = time.monotonic()
+        if now - self._focus_cached_at > self._focus_ttl:
+            self._focus_value = self.window.has_keyboard_focus()
+            self._focus_cached_at = now
+        return self._focus_value
+
+    def _mapping(self, width: int, height: int) -> tuple[float, float, float, float]:
+        key = (width, height)
+        # Moving the hit to the end keeps the least recently used size first for eviction.
+        mapping = self._mappings.pop(key, None)
+        if mapping is None:
+            # The capture size rarely changes so only the few most recently used ones are kept.
+            if len(self._mappings) >= 4:
+                del self._mappings[next(iter(self._mappings))]
+            ax = self.game_width / (width - self.crop_left_px)
+            ay = self.game_height / (height - self.crop_top_px)
+            mapping = (ax, -self.crop_left_px * ax, ay, -self.crop_top_px * ay)
+        self._mappings[key] = mapping
+        return mapping
+
+    # Runs the whole scroll in one pool call so another request's mouse move cannot land between
+    # the move and the scroll.
+    def _scroll_down(self, x: int, y: int) -> None:
+        pyautogui.moveTo(x, y)
+        pyautogui.scroll(-200)
 
     # This is the init function that is called each time the bot connects to your service.
-    def Init(self, request: KeyInitRequest, context):
+    async def Init(self, request: KeyInitRequest, context):
         # This is a seed generated automatically by the bot for the first time the bot is run.
         # The seed is saved in the database and reused again later.
         # If you do not wish to use the bot provided delay for key down press, you can use this
@@ -43,7 +143,7 @@ class KeyInput(KeyInputServicer):
         # return KeyInitResponse(mouse_coordinate=Coordinate.Screen)
         return KeyInitResponse(mouse_coordinate=Coordinate.Relative)
 
-    def SendMouse(self, request: MouseRequest, context):
+    async def SendMouse(self, request: MouseRequest, context):
         # Regardless of the type of Coordinate return in Init(), the coordinates are always based on
         # the PC the bot is running in. And there are two cases you should consider:
         #
@@ -83,54 +183,66 @@ class KeyInput(KeyInputServicer):
         # These are for cropping the non-game UI portion of the app the game is running in.
         # For Moonlight/Sunshine, you can leave this as-is. This method can be unreliable due
         # this reason. You can also use PowerToys Screen Ruler to measure this non-game UI area.
-        crop_left_px = 0  # Change this until it feels correct
-        crop_top_px = 30  # Change this until it feels correct
-
-        game_width = 1366  # Assuming your game is 1366x768 full screen
-        game_height = 768  # Assuming your game is 1366x768 full screen
-        x = int(((x - crop_left_px) / (width - crop_left_px)) * game_width)
-        y = int(((y - crop_top_px) / (height - crop_top_px)) * game_height)
+        # The crop amounts and game size are set in __init__().
+        ax, bx, ay, by = self._mapping(width, height)
+        x = int(x * ax + bx)
+        y = int(y * ay + by)
 
         # Common logics, not very human but just an example
+        loop = asyncio.get_running_loop()
         if action == MouseAction.Move:
-            pyautogui.moveTo(x, y)
+            await loop.run_in_executor(self.io_pool, pyautogui.moveTo, x, y)
         elif action == MouseAction.Click:
-            pyautogui.click(x, y)
+            await loop.run_in_executor(self.io_pool, pyautogui.click, x, y)
         elif action == MouseAction.ScrollDown:
-            pyautogui.moveTo(x, y)
-            pyautogui.scroll(-200)
+            await loop.run_in_executor(self.io_pool, self._scroll_down, x, y)
 
         return MouseResponse()
 
-    def Send(self, request: KeyRequest, context):
-        if self.window.has_keyboard_focus():
+    async def Send(self, request: KeyRequest, context):
+        if self._focused():
             # This `key` is an enum representing the key the bot want your customized input to send.
             # You should map this to the key supported by your customized input method.
-            key = self.keys_map[request.key]
+            key = request.key
             # This is key down sleep milliseconds. It is generated automatically by the bot using the
-            # above seed. You should use this delay and `time.sleep(delay)` on key down.
-            key_down = request.down_ms / 1000.0
+            # above seed. You should hold the key down for this delay.
+            key_down_ns = int(request.down_ms * 1_000_000)
 
-            keyboard.send_keys(
-                "{" + key + " down}", pause=key_down, vk_packet=False)
-            keyboard.send_keys(
-                "{" + key + " up}", pause=0, vk_packet=False)
+            # The hold is measured from before key down so the time spent sending it counts
+            # towards the hold instead of adding on top of it.
+            deadline = time.perf_counter_ns() + key_down_ns
+            self._send_input(self.down_inputs[key])
+            await sleep_until(deadline)
+            self._send_input(self.up_inputs[key])
 
         return KeyResponse()
 
-    def SendUp(self, request: KeyUpRequest, context):
-        if self.window.has_keyboard_focus():
-            keyboard.send_keys(
-                "{" + self.keys_map[request.key] + " up}", pause=0, vk_packet=False)
+    async def SendUp(self, request: KeyUpRequest, context):
+        if self._focused():
+            self._send_input(self.up_inputs[request.key])
         return KeyUpResponse()
 
-    def SendDown(self, request: KeyDownRequest, context):
-        if self.window.has_keyboard_focus():
-            keyboard.send_keys(
-                "{" + self.keys_map[request.key] + " down}", pause=0, vk_packet=False)
+    async def SendDown(self, request: KeyDownRequest, context):
+        if self._focused():
+            self._send_input(self.down_inputs[request.key])
         return KeyDownResponse()
 
 
+async def serve(window: WindowSpecification, keys_map: dict[Key, str]) -> None:
+    # The bot keeps one connection open for the whole session, keepalive pings notice when it is
+    # dropped.
+    server = grpc.aio.server(options=[
+        ("grpc.keepalive_time_ms", 30000),
+        ("grpc.keepalive_timeout_ms", 10000),
+        ("grpc.http2.max_pings_without_data", 0),
+    ])
+    add_KeyInputServicer_to_server(KeyInput(window, keys_map), server)
+    server.add_insecure_port("[::]:5001")
+    await server.start()
+    print("Server started, listening on 5001")
+    await server.wait_for_termination()
+
+
 if __name__ == "__main__":
     window_args = {'class_name': 'MapleStoryClass'}
     window = Application().connect(
@@ -222,9 +334,5 @@ if __name__ == "__main__":
         Key.Slash: '/',
     }
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    add_KeyInputServicer_to_server(KeyInput(window, keys_map), server)
-    server.add_insecure_port("[::]:5001")
-    server.start()
-    print("Server started, listening on 5001")
-    server.wait_for_termination()
+    use_precise_timer()
+    asyncio.run(serve(window, keys_map))